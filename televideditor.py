@@ -1,11 +1,22 @@
 import os
+import sys
 import time
+import functools
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from requests_toolbelt import MultipartEncoder
 import json
 import logging
 import subprocess
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import cpu_count
 from PIL import Image, ImageDraw, ImageFont, ImageFilter
 import textwrap
+import shutil
 
 # --- Logging Configuration ---
 logging.basicConfig(
@@ -20,6 +31,9 @@ RAILWAY_SERVICE_ID = os.environ.get("RAILWAY_SERVICE_ID")  # <-- Add this
 # Add these to your Constants section
 UPSTASH_REDIS_REST_URL = os.environ.get("UPSTASH_REDIS_REST_URL")
 UPSTASH_REDIS_REST_TOKEN = os.environ.get("UPSTASH_REDIS_REST_TOKEN")
+REDIS_HEADERS = {"Authorization": f"Bearer {UPSTASH_REDIS_REST_TOKEN}"}
+# Seconds to block on BRPOP for the first job; 0 pops once and exits if the queue is empty
+JOB_WAIT_TIMEOUT = int(os.environ.get("JOB_WAIT_TIMEOUT", "0"))
 
 
 # --- ORIGINAL Video Processing Constants ---
@@ -29,7 +43,9 @@ COMP_SIZE_STR = f"{COMP_WIDTH}x{COMP_HEIGHT}"
 BACKGROUND_COLOR = "black"
 FPS = 30
 IMAGE_DURATION = 8
+START_TRIM = 0.4  # Seconds cut from the start of every render (the original -ss trim fix)
 MEDIA_FADE_DURATION = 10
+MEDIA_FADE_LEAD_IN = 0.33  # Seconds of black after the trim before the media starts fading in, as the original render had
 CAPTION_FADE_DURATION = 4
 MEDIA_Y_OFFSET = 0
 CAPTION_V_PADDING = 37
@@ -42,46 +58,127 @@ CAPTION_BG_COLOR = (255, 255, 255)
 SHADOW_COLOR = (0, 0, 0)
 SHADOW_OFFSET = (0, 0)
 SHADOW_BLUR_RADIUS = 20
+SHADOW_DOWNSCALE = 4  # The shadow is blurred at 1/N size, then scaled back up
+
+# --- Cached Rendering Resources ---
+CAPTION_FONT_PATH = f"{CAPTION_FONT}.ttf"
+if not os.path.exists(CAPTION_FONT_PATH): raise FileNotFoundError(f"Font file not found: {CAPTION_FONT_PATH}")
+_CAPTION_FONT = ImageFont.truetype(CAPTION_FONT_PATH, CAPTION_FONT_SIZE)
+_DUMMY_DRAW = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+_CAPTION_WRAPPER = textwrap.TextWrapper(width=35, break_long_words=True)
+
+# --- Video Encoder Selection ---
+# Hardware encoders are tried in order; each entry is the full set of codec arguments.
+VIDEO_ENCODER_ARGS = {
+    'h264_nvenc': ['-c:v', 'h264_nvenc', '-preset', 'p1', '-tune', 'ull', '-pix_fmt', 'yuv420p'],
+    'h264_qsv': ['-c:v', 'h264_qsv', '-preset', 'veryfast', '-pix_fmt', 'nv12'],
+    'libx264': ['-c:v', 'libx264', '-preset', 'ultrafast', '-tune', 'stillimage', '-crf', '28',
+                '-x264-params', 'keyint=30:min-keyint=30:scenecut=0', '-pix_fmt', 'yuv420p'],
+}
+
+def detect_video_encoder():
+    """Returns the first hardware H.264 encoder that can actually open a session, else libx264."""
+    try:
+        listed = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], capture_output=True, text=True, timeout=10).stdout
+    except Exception as e:
+        logging.warning(f"Could not list ffmpeg encoders, using libx264: {e}")
+        return 'libx264'
+    for encoder in ['h264_nvenc', 'h264_qsv']:
+        if encoder not in listed: continue
+        # Being compiled in doesn't mean the hardware is present, so try a one-frame encode
+        probe = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-f', 'lavfi', '-i', 'color=s=256x256:d=0.1',
+                 '-frames:v', '1', *VIDEO_ENCODER_ARGS[encoder], '-f', 'null', '-']
+        try:
+            if subprocess.run(probe, capture_output=True, timeout=15).returncode == 0: return encoder
+        except Exception: pass
+    return 'libx264'
+
+VIDEO_ENCODER = detect_video_encoder()
+logging.info(f"Using video encoder: {VIDEO_ENCODER}")
+
+# --- Concurrency ---
+MAX_WORKERS = min(cpu_count(), 4)  # Jobs rendered at once
+FFMPEG_THREADS = max(1, cpu_count() // MAX_WORKERS)  # Each job's share of the cores, so concurrent ffmpegs don't oversubscribe
 
 # --- File Paths ---
 DOWNLOAD_PATH = "downloads"
 OUTPUT_PATH = "outputs"
 
+# --- HTTP Session ---
+UPLOAD_CHUNK_SIZE = 100 * 1024  # Block size for streamed request bodies (urllib3 defaults to 8-16 KiB)
+
+class StreamingHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose connections send streamed bodies in UPLOAD_CHUNK_SIZE blocks."""
+    def init_poolmanager(self, *args, **kwargs):
+        # urllib3 1.x rejects unknown pool keys on every request, so only pass blocksize where it exists
+        if int(urllib3.__version__.split('.')[0]) >= 2: kwargs['blocksize'] = UPLOAD_CHUNK_SIZE
+        super().init_poolmanager(*args, **kwargs)
+
+def create_session():
+    """Builds a keep-alive session so repeated calls to the same host reuse one TLS connection."""
+    session = requests.Session()
+    # read=0: the Redis BRPOP call is a GET that pops, so a lost response must not be replayed
+    retries = Retry(total=3, read=0, backoff_factor=0.3, status_forcelist=[500, 502, 503, 504])
+    adapter = StreamingHTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+SESSION = create_session()
+
 # --- Helper Functions ---
 def cleanup_files(file_list):
     for file_path in file_list:
-        if file_path and os.path.exists(file_path):
-            try: os.remove(file_path)
-            except OSError as e: logging.error(f"Error deleting file {file_path}: {e}")
+        if not file_path: continue
+        try: os.remove(file_path)
+        except FileNotFoundError: pass
+        except OSError as e: logging.error(f"Error deleting file {file_path}: {e}")
 
 def create_directories():
     for path in [DOWNLOAD_PATH, OUTPUT_PATH]:
-        if not os.path.exists(path): os.makedirs(path)
+        os.makedirs(path, exist_ok=True)
+
+def warm_up():
+    """Pages in ffmpeg's shared libraries and PIL's filter code before the first job needs them."""
+    try: subprocess.run(['ffmpeg', '-hide_banner', '-version'], capture_output=True, timeout=5)
+    except Exception as e: logging.warning(f"ffmpeg warm-up failed: {e}")
+    Image.new('RGBA', (1, 1)).filter(ImageFilter.GaussianBlur(radius=1))
+
+def init_worker():
+    """Pool initializer: forked workers must not share the parent's pooled sockets."""
+    global SESSION
+    SESSION = create_session()
+    create_directories()
 
 # --- Railway API Functions ---
 def stop_railway_deployment():
     logging.info("Attempting to stop Railway deployment...")
     api_token, service_id = os.environ.get("RAILWAY_API_TOKEN"), os.environ.get("RAILWAY_SERVICE_ID")
-    if not api_token or not service_id:
+    deployment_id = os.environ.get("RAILWAY_DEPLOYMENT_ID")  # Injected by Railway into the running container
+    if not api_token or not (deployment_id or service_id):
         logging.warning("RAILWAY variables not set. Skipping stop.")
         return
     graphql_url, headers = "https://backboard.railway.app/graphql/v2", {"Authorization": f"Bearer {api_token}", "Content-Type": "application/json"}
-    get_id_query = {"query": "query getLatestDeployment($serviceId: String!) { service(id: $serviceId) { deployments(first: 1) { edges { node { id } } } } }", "variables": {"serviceId": service_id}}
-    try:
-        response = requests.post(graphql_url, json=get_id_query, headers=headers, timeout=15)
-        response.raise_for_status()
-        edges = response.json().get('data', {}).get('service', {}).get('deployments', {}).get('edges', [])
-        if not edges:
-             logging.warning("No active deployments found to stop.")
-             return
-        deployment_id = edges[0]['node']['id']
-        logging.info(f"Fetched latest deployment ID: {deployment_id}")
-    except Exception as e:
-        logging.error(f"Failed to get Railway deployment ID: {e}")
-        return
+    if deployment_id:
+        logging.info(f"Using current deployment ID: {deployment_id}")
+    else:
+        # Fallback for local runs, where Railway doesn't inject the deployment ID
+        get_id_query = {"query": "query getLatestDeployment($serviceId: String!) { service(id: $serviceId) { deployments(first: 1) { edges { node { id } } } } }", "variables": {"serviceId": service_id}}
+        try:
+            response = SESSION.post(graphql_url, json=get_id_query, headers=headers, timeout=15)
+            response.raise_for_status()
+            edges = response.json().get('data', {}).get('service', {}).get('deployments', {}).get('edges', [])
+            if not edges:
+                 logging.warning("No active deployments found to stop.")
+                 return
+            deployment_id = edges[0]['node']['id']
+            logging.info(f"Fetched latest deployment ID: {deployment_id}")
+        except Exception as e:
+            logging.error(f"Failed to get Railway deployment ID: {e}")
+            return
     stop_mutation = {"query": "mutation deploymentStop($id: String!) { deploymentStop(id: $id) }", "variables": {"id": deployment_id}}
     try:
-        response = requests.post(graphql_url, json=stop_mutation, headers=headers, timeout=15)
+        response = SESSION.post(graphql_url, json=stop_mutation, headers=headers, timeout=15)
         response.raise_for_status()
         logging.info("Successfully sent stop command to Railway.")
     except Exception as e:
@@ -89,15 +186,28 @@ def stop_railway_deployment():
 
 # --- Worker Communication ---
 def fetch_job_from_redis():
-    url = f"{UPSTASH_REDIS_REST_URL}/rpop/job_queue"
-    headers = {"Authorization": f"Bearer {UPSTASH_REDIS_REST_TOKEN}"}
+    """Pops a job and reads the remaining queue length in one pipelined round trip; returns (job, remaining), remaining is None on error."""
+    url = f"{UPSTASH_REDIS_REST_URL}/pipeline"
     try:
-        response = requests.get(url, headers=headers, timeout=10)
+        response = SESSION.post(url, headers=REDIS_HEADERS, json=[["RPOP", "job_queue"], ["LLEN", "job_queue"]], timeout=10)
         response.raise_for_status()
-        result = response.json().get("result")
-        return json.loads(result) if result else None
+        popped, queue_len = response.json()
+        result = popped.get("result")
+        return (json.loads(result) if result else None), queue_len.get("result") or 0
     except Exception as e:
         logging.error(f"Redis fetch failed: {e}")
+        return None, None
+
+def fetch_job_blocking(timeout_s):
+    """Blocks server-side on BRPOP until a job arrives or timeout_s elapses."""
+    url = f"{UPSTASH_REDIS_REST_URL}/brpop/job_queue/{timeout_s}"
+    try:
+        response = SESSION.get(url, headers=REDIS_HEADERS, timeout=timeout_s + 10)
+        response.raise_for_status()
+        result = response.json().get("result")
+        return json.loads(result[1]) if result else None
+    except Exception as e:
+        logging.error(f"Redis blocking fetch failed: {e}")
         return None
 
 def submit_result_to_worker(job_data, video_path):
@@ -105,8 +215,9 @@ def submit_result_to_worker(job_data, video_path):
     logging.info(f"Submitting result for job {job_data['job_id']}...")
     try:
         with open(video_path, 'rb') as video_file:
-            files = {'video': ('final_video.mp4', video_file, 'video/mp4'), 'job_data': (None, json.dumps(job_data), 'application/json')}
-            response = requests.post(url, files=files, timeout=300)
+            # Stream the multipart body from disk instead of building it in memory.
+            body = MultipartEncoder(fields={'video': ('final_video.mp4', video_file, 'video/mp4'), 'job_data': (None, json.dumps(job_data), 'application/json')})
+            response = SESSION.post(url, data=body, headers={'Content-Type': body.content_type}, timeout=300)
             response.raise_for_status()
         logging.info("Successfully submitted result to worker.")
     except Exception as e:
@@ -116,37 +227,98 @@ def submit_result_to_worker(job_data, video_path):
 def download_file_from_url(url, save_path):
     try:
         headers = {'User-Agent': 'Mozilla/5.0'}
-        with requests.get(url, stream=True, timeout=60, headers=headers) as r:
+        with SESSION.get(url, stream=True, timeout=60, headers=headers) as r:
             r.raise_for_status()
+            r.raw.decode_content = True  # Still undo any gzip/deflate transfer encoding
             with open(save_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192): f.write(chunk)
+                shutil.copyfileobj(r.raw, f, length=1024 * 1024)
         logging.info(f"Downloaded: {save_path}")
         return save_path
     except Exception as e:
         logging.error(f"Download failed for {url}: {e}")
         return None
 
+@functools.lru_cache(maxsize=32)
+def _probe_image_size(media_path, mtime):
+    with Image.open(media_path) as img:
+        return img.size  # header only, pixels are never loaded
+
+def get_media_dimensions(media_path):
+    """Returns (width, height), cached per path and mtime so repeat lookups don't reopen the file."""
+    return _probe_image_size(media_path, os.path.getmtime(media_path))
+
+def create_background_image(media_path, scaled_media_h, media_y_pos, job_id):
+    """Scales the media onto the black canvas once and writes it as a raw yuv420p frame for ffmpeg to loop."""
+    with Image.open(media_path) as img:
+        media = img.convert('RGBA').resize((COMP_WIDTH, scaled_media_h), Image.BICUBIC)
+    canvas = Image.new('RGB', (COMP_WIDTH, COMP_HEIGHT), BACKGROUND_COLOR)
+    canvas.paste(media, (0, media_y_pos), media)
+    # Convert to limited-range BT.601 yuv420p once here rather than per frame in swscale.
+    # PIL's YCbCr is full range (JFIF), so squeeze Y into 16-235 and chroma into 16-240.
+    y, cb, cr = canvas.convert('YCbCr').split()
+    y = y.point(lambda v: round(16 + v * 219 / 255))
+    chroma_size = (COMP_WIDTH // 2, COMP_HEIGHT // 2)
+    cb, cr = (c.resize(chroma_size, Image.BILINEAR).point(lambda v: round(128 + (v - 128) * 224 / 255)) for c in (cb, cr))
+    background_path = os.path.join(OUTPUT_PATH, f"composed_{job_id}.yuv")
+    with open(background_path, 'wb') as f:
+        for plane in (y, cb, cr): f.write(plane.tobytes())
+    return background_path
+
+def open_download_stream(url):
+    """Opens a streaming GET for a file that is piped straight into ffmpeg instead of saved to disk."""
+    r = None
+    try:
+        r = SESSION.get(url, stream=True, timeout=60, headers={'User-Agent': 'Mozilla/5.0'})
+        r.raise_for_status()
+        logging.info(f"Streaming: {url}")
+        return r
+    except Exception as e:
+        if r is not None: r.close()
+        logging.error(f"Stream open failed for {url}: {e}")
+        return None
+
+def pipe_stream_to_fd(response, write_fd):
+    """Copies a streamed HTTP body into a pipe; ffmpeg closing its end early is not an error."""
+    try:
+        with os.fdopen(write_fd, 'wb') as pipe:
+            for chunk in response.iter_content(chunk_size=65536): pipe.write(chunk)
+    except BrokenPipeError:
+        pass
+
 def create_caption_image(text, job_id):
     padded_text = ("\n" * CAPTION_TOP_PADDING_LINES) + text
-    font_path = f"{CAPTION_FONT}.ttf"
-    if not os.path.exists(font_path): raise FileNotFoundError(f"Font file not found: {font_path}")
-    font = ImageFont.truetype(font_path, CAPTION_FONT_SIZE)
-    wrapped_text = "\n".join([item for line in padded_text.split('\n') for item in textwrap.wrap(line, width=35, break_long_words=True) or ['']])
-    dummy_draw = ImageDraw.Draw(Image.new('RGB', (0,0)))
-    text_bbox = dummy_draw.multiline_textbbox((0, 0), wrapped_text, font=font, align="center", spacing=CAPTION_LINE_SPACING, stroke_width=1)
+    font = _CAPTION_FONT
+    wrapped_text = "\n".join([item for line in padded_text.split('\n') for item in _CAPTION_WRAPPER.wrap(line) or ['']])
+    text_bbox = _DUMMY_DRAW.multiline_textbbox((0, 0), wrapped_text, font=font, align="center", spacing=CAPTION_LINE_SPACING, stroke_width=2)
     text_width, text_height = int(text_bbox[2] - text_bbox[0]), int(text_bbox[3] - text_bbox[1])
-    img_padding = SHADOW_BLUR_RADIUS * 4
+    shadow_enabled = SHADOW_BLUR_RADIUS > 0
+    img_padding = SHADOW_BLUR_RADIUS * 4 if shadow_enabled else 4  # 4px still leaves room for the stroke
     img_width, img_height = text_width + img_padding, text_height + img_padding
-    shadow_img = Image.new('RGBA', (img_width, img_height), (0, 0, 0, 0))
-    shadow_draw = ImageDraw.Draw(shadow_img)
-    shadow_pos = (img_padding / 2 + SHADOW_OFFSET[0], img_padding / 2 + SHADOW_OFFSET[1])
-    shadow_draw.multiline_text(shadow_pos, wrapped_text, font=font, fill=SHADOW_COLOR, anchor="la", align="center", spacing=CAPTION_LINE_SPACING, stroke_width=2, stroke_fill=SHADOW_COLOR)
-    shadow_img = shadow_img.filter(ImageFilter.GaussianBlur(radius=SHADOW_BLUR_RADIUS))
-    final_draw = ImageDraw.Draw(shadow_img)
-    text_pos = (img_padding / 2, img_padding / 2)
-    final_draw.multiline_text(text_pos, wrapped_text, font=font, fill=CAPTION_TEXT_COLOR, anchor="la", align="center", spacing=CAPTION_LINE_SPACING, stroke_width=2, stroke_fill=(0, 0, 0))
+    text_layer = Image.new('RGBA', (img_width, img_height), (0, 0, 0, 0))
+    text_pos = (img_padding // 2, img_padding // 2)
+    ImageDraw.Draw(text_layer).multiline_text(text_pos, wrapped_text, font=font, fill=CAPTION_TEXT_COLOR, anchor="la", align="center", spacing=CAPTION_LINE_SPACING, stroke_width=2, stroke_fill=(0, 0, 0))
+    caption_img = text_layer
+    if shadow_enabled:
+        # The shadow is the stroked text's silhouette, so reuse the rendered alpha instead of laying the text out again.
+        shadow_mask = Image.new('L', (img_width, img_height), 0)
+        shadow_mask.paste(text_layer.getchannel('A'), SHADOW_OFFSET)
+        # Blur only the region the shadow can reach instead of the whole transparent canvas.
+        bbox = shadow_mask.getbbox()
+        if bbox:
+            blur_margin = SHADOW_BLUR_RADIUS * 2
+            expanded_bbox = (max(bbox[0] - blur_margin, 0), max(bbox[1] - blur_margin, 0),
+                             min(bbox[2] + blur_margin, img_width), min(bbox[3] + blur_margin, img_height))
+            region = shadow_mask.crop(expanded_bbox)
+            # A soft shadow has no fine detail, so blurring a downscaled mask and scaling it back looks the same.
+            small_size = (max(region.width // SHADOW_DOWNSCALE, 1), max(region.height // SHADOW_DOWNSCALE, 1))
+            small = region.resize(small_size, Image.BILINEAR).filter(ImageFilter.GaussianBlur(radius=SHADOW_BLUR_RADIUS / SHADOW_DOWNSCALE))
+            shadow_mask.paste(small.resize(region.size, Image.BILINEAR), expanded_bbox[:2])
+        shadow_img = Image.new('RGBA', (img_width, img_height), SHADOW_COLOR + (0,))
+        shadow_img.putalpha(shadow_mask)
+        shadow_img.alpha_composite(text_layer)
+        caption_img = shadow_img
     caption_image_path = os.path.join(OUTPUT_PATH, f"caption_{job_id}.png")
-    shadow_img.save(caption_image_path)
+    caption_img.save(caption_image_path)
     return caption_image_path
 
 
@@ -156,60 +328,66 @@ def process_video_job(job_data):
     logging.info(f"Starting processing for job_id: {job_id}")
 
     files_to_clean = []
+    bgm_stream = None
     
     try:
         # ADAPTED: Download GDrive links instead of Telegram file_id
-        media_path = download_file_from_url(job_data['bg_link'], os.path.join(DOWNLOAD_PATH, f"bg_{job_id}.jpg"))
-        bgm_path = download_file_from_url(job_data['bgm_link'], os.path.join(DOWNLOAD_PATH, f"bgm_{job_id}.mp3"))
-        if not media_path or not bgm_path: raise ValueError("Media download failed.")
-        files_to_clean.extend([media_path, bgm_path])
+        # The image stays on disk (PIL needs its size); the BGM is piped into ffmpeg's stdin
+        # The image download, the BGM request and the caption render are independent, so run them together
+        with ThreadPoolExecutor(max_workers=3) as prep_pool:
+            fut_media = prep_pool.submit(download_file_from_url, job_data['bg_link'], os.path.join(DOWNLOAD_PATH, f"bg_{job_id}.jpg"))
+            fut_bgm = prep_pool.submit(open_download_stream, job_data['bgm_link'])
+            # ADAPTED: Use 'quote' key from new job data
+            fut_caption = prep_pool.submit(create_caption_image, job_data['quote'], job_id)
+            media_path = fut_media.result()
+            if media_path: files_to_clean.append(media_path)
+            bgm_stream = fut_bgm.result()
+            caption_image_path = fut_caption.result()
+            files_to_clean.append(caption_image_path)
+        if not media_path or bgm_stream is None: raise ValueError("Media download failed.")
 
         # ADAPTED: Set variables as they would be for an image in your old script
-        with Image.open(media_path) as img:
-            media_w, media_h = img.width, img.height
+        media_w, media_h = get_media_dimensions(media_path)
         final_duration = IMAGE_DURATION # Use fixed duration for image
 
-        # ADAPTED: Use 'quote' key from new job data
-        caption_image_path = create_caption_image(job_data['quote'], job_id)
-        files_to_clean.append(caption_image_path)
-
         # PRESERVED: Your original geometry calculations
         output_filepath = os.path.join(OUTPUT_PATH, f"output_{job_id}.mp4")
         scale_ratio = COMP_WIDTH / media_w
         scaled_media_h = int(media_h * scale_ratio)
         media_y_pos = int((COMP_HEIGHT / 2 - scaled_media_h / 2) + MEDIA_Y_OFFSET)
 
+        # Media on the black background is static, so compose it once in PIL
+        background_path = create_background_image(media_path, scaled_media_h, media_y_pos, job_id)
+        files_to_clean.append(background_path)
+
         # --- FFmpeg Command Assembly (Following Your Original Structure) ---
         command = [
             'ffmpeg', '-y',
-            # Input 0: Background (Your original)
-            '-f', 'lavfi', '-i', f'color=c={BACKGROUND_COLOR}:s={COMP_SIZE_STR}:d={final_duration}',
-            # Input 1: Media (Image, looped as per your original)
-            '-loop', '1', '-t', str(final_duration), '-i', media_path,
-            # Input 2: Caption Image (looped as per your original)
-            '-loop', '1', '-i', caption_image_path,
-            # ADAPTED: Add BGM as a new input
-            '-i', bgm_path
+            # Input 0: Pre-composed background (media already scaled and placed), one raw yuv420p frame on repeat
+            '-f', 'rawvideo', '-pixel_format', 'yuv420p', '-video_size', COMP_SIZE_STR, '-framerate', str(FPS),
+            '-stream_loop', '-1', '-t', str(final_duration), '-i', background_path,
+            # Input 1: Caption Image (looped as per your original, bounded at the demuxer like the background)
+            '-loop', '1', '-t', str(final_duration), '-i', caption_image_path,
+            # ADAPTED: Add BGM as a new input, streamed in through stdin
+            '-i', 'pipe:0'
         ]
         
         filter_parts = []
         
-        # PRESERVED: Your original filter for media scaling and fade
-        media_fade_filter = f",fade=t=in:st=0:d={MEDIA_FADE_DURATION}"
-        filter_parts.append(f"[1:v]scale={COMP_WIDTH}:-1,setpts=PTS-STARTPTS{media_fade_filter}[scaled_media]")
+        # PRESERVED: Your original media fade (fading over black == fading the composed frame), starting after the original black lead-in
+        media_fade_filter = f",fade=t=in:st={START_TRIM + MEDIA_FADE_LEAD_IN}:d={MEDIA_FADE_DURATION}"
+        filter_parts.append(f"[0:v]setpts=PTS-STARTPTS{media_fade_filter}[base_scene]")
         
-        # PRESERVED: Your original filter for the caption
-        caption_fade_filter = f",fade=t=in:st=0:d={CAPTION_FADE_DURATION}"
-        filter_parts.append(f"[2:v]format=rgba,trim=duration={final_duration}{caption_fade_filter}[faded_caption]")
-
-        # PRESERVED: Your original overlay logic
-        filter_parts.extend([
-            f"[0:v][scaled_media]overlay=(W-w)/2:{media_y_pos}[base_scene]",
-            f"[base_scene][faded_caption]overlay=(W-w)/2:(H-h)/2[final_v]"
-        ])
+        # PRESERVED: Your original filter for the caption (fade the alpha plane only)
+        caption_fade_filter = f",fade=t=in:st=0:d={CAPTION_FADE_DURATION}:alpha=1"
+        filter_parts.append(f"[1:v]format=rgba{caption_fade_filter}[faded_caption]")
+
+        # PRESERVED: Your original caption overlay
+        # The start trim happens in the graph so the cut frames never leave the filters
+        filter_parts.append(f"[base_scene][faded_caption]overlay=(W-w)/2:(H-h)/2,trim=start={START_TRIM},setpts=PTS-STARTPTS[final_v]")
         
-        # ADAPTED: Add a filter for the new audio stream
-        audio_filter = f"[3:a]atrim=0:{final_duration},afade=t=out:st={final_duration-2}:d=2[final_a]"
+        # ADAPTED: Add a filter for the new audio stream (trimmed to match; the fade-out still ends at final_duration)
+        audio_filter = f"[2:a]atrim={START_TRIM}:{final_duration},asetpts=PTS-STARTPTS,afade=t=out:st={final_duration-START_TRIM-2}:d=2[final_a]"
         filter_parts.append(audio_filter)
 
         filter_complex = ";".join(filter_parts)
@@ -217,24 +395,35 @@ def process_video_job(job_data):
         # ADAPTED: Add the new audio stream to the map
         map_args = ['-map', '[final_v]', '-map', '[final_a]']
         
-        # PRESERVED: Your original encoding options and trim fix
+        # PRESERVED: Your original encoding options (trim fix now lives in the filter graph)
         command.extend([
+            '-filter_complex_threads', str(FFMPEG_THREADS),
             '-filter_complex', filter_complex,
             *map_args,
-            '-ss', '0.4', # Your trim fix
-            '-c:v', 'libx264',
-            '-preset', 'fast', '-tune', 'zerolatency',
+            *VIDEO_ENCODER_ARGS[VIDEO_ENCODER],
+            '-threads', str(FFMPEG_THREADS),
             '-c:a', 'aac', '-b:a', '192k',
             '-r', str(FPS),
-            '-pix_fmt', 'yuv420p',
             '-t', str(final_duration), # Explicitly set duration
             output_filepath
         ])
         
-        result = subprocess.run(command, capture_output=True, text=True, timeout=300)
-        if result.returncode != 0:
-            logging.error(f"FFMPEG STDERR: {result.stderr}")
-            raise subprocess.CalledProcessError(result.returncode, command, stderr=result.stderr)
+        read_fd, write_fd = os.pipe()
+        # stderr goes to a file so ffmpeg never waits on a Python reader; it's only read on failure
+        with tempfile.TemporaryFile() as ffmpeg_log:
+            with ThreadPoolExecutor(max_workers=1) as feeder_pool:
+                feeder = feeder_pool.submit(pipe_stream_to_fd, bgm_stream, write_fd)
+                try:
+                    result = subprocess.run(command, stdin=read_fd, stdout=subprocess.DEVNULL, stderr=ffmpeg_log, timeout=300)
+                finally:
+                    os.close(read_fd)  # Unblocks the feeder if ffmpeg stopped reading early
+                bgm_error = feeder.exception()
+            if result.returncode != 0:
+                ffmpeg_log.seek(max(ffmpeg_log.seek(0, os.SEEK_END) - 4096, 0))
+                stderr_tail = ffmpeg_log.read().decode(errors='replace')
+                logging.error(f"FFMPEG STDERR: {stderr_tail}")
+                raise subprocess.CalledProcessError(result.returncode, command, stderr=stderr_tail)
+        if bgm_error: raise ValueError(f"BGM stream failed: {bgm_error}")
         
         logging.info(f"FFmpeg processing finished for job {job_id}.")
         files_to_clean.append(output_filepath)
@@ -247,6 +436,7 @@ def process_video_job(job_data):
         logging.error(f"Failed to process job {job_id}: {error_snippet}", exc_info=True)
     
     finally:
+        if bgm_stream is not None: bgm_stream.close()
         logging.info(f"Cleaning up files for job {job_id}.")
         cleanup_files(files_to_clean)
 
@@ -254,11 +444,39 @@ def process_video_job(job_data):
 if __name__ == '__main__':
     logging.info("Starting Python Job Processor...")
     create_directories()
-    job = fetch_job_from_redis()
+    warm_up()
+    # BRPOP with a timeout of 0 would block forever, so only use it when a wait is configured
+    job = fetch_job_blocking(JOB_WAIT_TIMEOUT) if JOB_WAIT_TIMEOUT > 0 else fetch_job_from_redis()[0]
     if job:
-        logging.info("Job found. Processing...")
-        process_video_job(job)
+        # Pop a job only when a worker is free to start it; anything popped early is lost if this container dies
+        with ProcessPoolExecutor(max_workers=MAX_WORKERS, initializer=init_worker) as executor:
+            in_flight = {executor.submit(process_video_job, job)}
+            failed_polls = 0
+            try:
+                while True:
+                    # Refill before checking for the exit, so jobs queued while others ran are still picked up
+                    while len(in_flight) < MAX_WORKERS:
+                        job, remaining = fetch_job_from_redis()
+                        if not job: break
+                        in_flight.add(executor.submit(process_video_job, job))
+                        if not remaining: break
+                    if not in_flight:
+                        # Only an empty pop means the queue is drained; a failed one says nothing about it
+                        if remaining is not None or failed_polls >= 3: break
+                        failed_polls += 1
+                        time.sleep(2)
+                        continue
+                    logging.info(f"{len(in_flight)} job(s) in progress.")
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        try: future.result()
+                        except BrokenProcessPool: raise
+                        except Exception as e: logging.error(f"Job crashed outside its own error handling: {e}", exc_info=True)
+            except BrokenProcessPool as e:
+                logging.error(f"A worker process died, abandoning remaining jobs: {e}")
     else:
-        logging.info("No job found in queue.")
+        # Nothing ran, so there is nothing to stop; skip the Railway round trips on idle wake-ups
+        logging.info("No job found in queue. Skipping shutdown.")
+        sys.exit(0)
     logging.info("Task complete. Requesting shutdown.")
     stop_railway_deployment()